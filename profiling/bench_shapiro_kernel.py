@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import timeit
+
+import numpy as np
+
+import pint.models.solar_system_shapiro
+from pint.models.solar_system_shapiro import SolarSystemShapiro
+
+# Compare ways of computing the object distances used in the solar system
+# Shapiro delay, and time the full kernel with and without numba, for a
+# stack of the Sun and five planets.
+nobj = 6
+number = 20
+rng = np.random.default_rng(0)
+for ntoas in (1000, 100000, 1000000):
+    obj_pos = rng.normal(size=(nobj, ntoas, 3)) * 1.5e11
+    psr_dir = rng.normal(size=(ntoas, 3))
+    psr_dir /= np.linalg.norm(psr_dir, axis=1)[:, None]
+    T_obj = np.full(nobj, 1e-6)
+
+    print("Number of TOAs: " + str(ntoas))
+    t = timeit.timeit(
+        lambda: np.sqrt(np.einsum("bij,bij->bi", obj_pos, obj_pos)), number=number
+    )
+    print("  einsum norm:      %.3e s" % (t / number))
+    t = timeit.timeit(lambda: np.linalg.norm(obj_pos, axis=2), number=number)
+    print("  linalg.norm:      %.3e s" % (t / number))
+    t = timeit.timeit(lambda: np.sqrt(np.sum(obj_pos**2, axis=2)), number=number)
+    print("  sum of squares:   %.3e s" % (t / number))
+
+    kernel = pint.models.solar_system_shapiro._shapiro_kernel
+    if kernel is not None:
+        # Compile before timing
+        SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj)
+        t = timeit.timeit(
+            lambda: SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj),
+            number=number,
+        )
+        print("  numba kernel:     %.3e s" % (t / number))
+    pint.models.solar_system_shapiro._shapiro_kernel = None
+    t = timeit.timeit(
+        lambda: SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj),
+        number=number,
+    )
+    print("  numpy kernel:     %.3e s" % (t / number))
+    pint.models.solar_system_shapiro._shapiro_kernel = kernel
@@ -1,10 +1,17 @@
 """Solar system Shapiro delay."""
 
+import math
+
 import astropy.constants as const
 import astropy.units as u
 import numpy
 from loguru import logger as log
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 from pint import (
     Tearth,
     Tjupiter,
@@ -19,6 +26,33 @@ from pint import (
 from pint.models.parameter import boolParameter
 from pint.models.timing_model import DelayComponent
 
+# log(x / AU) == log(x) - _LOG_AU_M, with x in meters
+_LOG_AU_M = math.log(const.au.to_value(u.m))
+
+# Precision of the positions and pulsar direction fed to the Shapiro kernel.
+# numpy.float32 halves the memory traffic and keeps the error well below a
+# nanosecond away from the Sun, but loses accuracy for lines of sight within
+# a few degrees of it (r - r cos(theta) cancels), so float64 is the default.
+_SHAPIRO_DTYPE = numpy.float64
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _shapiro_kernel(obj_pos, psr_dir, T_obj, log_au, out):
+        """Accumulate the summed Shapiro delay of stacked objects into ``out``."""
+        for i in prange(obj_pos.shape[1]):
+            nx, ny, nz = psr_dir[i, 0], psr_dir[i, 1], psr_dir[i, 2]
+            acc = 0.0
+            for b in range(obj_pos.shape[0]):
+                x, y, z = obj_pos[b, i, 0], obj_pos[b, i, 1], obj_pos[b, i, 2]
+                r = math.sqrt(x * x + y * y + z * z)
+                rcostheta = x * nx + y * ny + z * nz
+                acc += T_obj[b] * (math.log(r - rcostheta) - log_au)
+            out[i] -= 2.0 * acc
+
+else:
+    _shapiro_kernel = None
+
 
 class SolarSystemShapiro(DelayComponent):
     """Shapiro delay due to light bending near Solar System objects.
@@ -42,6 +76,21 @@ class SolarSystemShapiro(DelayComponent):
             )
         )
         self.delay_funcs_component += [self.solar_system_shapiro_delay]
+        self.shapiro_cache = None
+        self.psr_dir_cache = None
+
+    def setup(self):
+        super().setup()
+        # Make sure the cached delay and pulsar direction are cleared
+        self.shapiro_cache = None
+        self.psr_dir_cache = None
+
+    def __getstate__(self):
+        # The caches belong to one set of TOAs; don't copy or pickle them
+        state = self.__dict__.copy()
+        state["shapiro_cache"] = None
+        state["psr_dir_cache"] = None
+        return state
 
     # Put masses in a convenient dictionary
     _ss_mass_sec = {
@@ -56,21 +105,56 @@ class SolarSystemShapiro(DelayComponent):
         "neptune": Tneptune.value,
     }
 
+    # TOA table column and mass for each planet included by PLANET_SHAPIRO
+    _ss_planets = (
+        ("obs_jupiter_pos", Tjupiter.value),
+        ("obs_saturn_pos", Tsaturn.value),
+        ("obs_venus_pos", Tvenus.value),
+        ("obs_uranus_pos", Turanus.value),
+        ("obs_neptune_pos", Tneptune.value),
+    )
+
     @staticmethod
-    def ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj):
+    def ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj, out=None):
         """
-        ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj)
+        ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj, out=None)
 
         returns Shapiro delay in seconds for a solar system object.
 
         Inputs:
-          obj_pos : position vector from Earth to SS object, with Units
-          psr_dir : unit vector in direction of pulsar
+          obj_pos : position vector from Earth to SS object, in meters if a
+            plain array; Quantities and table columns with units are converted
+          psr_dir : unit vector in direction of pulsar (plain array), either
+            one per TOA or a single (3,) vector for all of them
           T_obj : mass of object in seconds (GM/c^3)
+          out : optional array the delay is added to in place and returned
+
+        obj_pos may also be a stack of shape (n_obj, N, 3) with T_obj a
+        sequence of n_obj masses, in which case the summed delay of all the
+        objects is returned. Uses a compiled kernel if numba is available.
+
+        Inputs that are not C-contiguous are copied, so callers handling
+        several objects should stack and lay out the arrays once up front.
         """
-        # TODO: numpy.sum currently loses units in some cases...
-        r = (numpy.sqrt(numpy.sum(obj_pos**2, axis=1))) * obj_pos.unit
-        rcostheta = numpy.sum(obj_pos * psr_dir, axis=1)
+        if getattr(obj_pos, "unit", None) is not None:
+            obj_pos = u.Quantity(obj_pos).to_value(u.m)
+        if getattr(psr_dir, "unit", None) is not None:
+            psr_dir = u.Quantity(psr_dir).to_value(u.dimensionless_unscaled)
+        obj_pos = numpy.ascontiguousarray(obj_pos)
+        T_obj = numpy.atleast_1d(numpy.asarray(T_obj, dtype=numpy.float64))
+        if obj_pos.ndim == 2:
+            obj_pos = obj_pos[numpy.newaxis]
+        # Without proper motion the direction is a single vector
+        psr_dir = numpy.ascontiguousarray(
+            numpy.broadcast_to(psr_dir, obj_pos.shape[1:])
+        )
+        if out is None:
+            out = numpy.zeros(obj_pos.shape[1])
+        if _shapiro_kernel is not None:
+            _shapiro_kernel(obj_pos, psr_dir, T_obj, _LOG_AU_M, out)
+            return out
+        r = numpy.sqrt(numpy.einsum("bij,bij->bi", obj_pos, obj_pos))
+        rcostheta = numpy.einsum("bij,ij->bi", obj_pos, psr_dir)
         # This is the 2nd to last term from Eqn 4.6 in Backer &
         # Hellings, ARAA, 1986 with gamma = 1 (as defined by GR).  We
         # have the opposite sign of the cos(theta) term, since our
@@ -79,7 +163,13 @@ class SolarSystemShapiro(DelayComponent):
         # pulsar (as described after Eqn 4.3 in the paper).
         # See also https://en.wikipedia.org/wiki/Shapiro_time_delay
         # where \Delta t = \frac{2GM}{c^3}\log(1-\vec{R}\cdot\vec{x})
-        return -2.0 * T_obj * numpy.log((r - rcostheta) / const.au).value
+        # Near alignment r - rcostheta is exact (Sterbenz), so the error comes
+        # only from rounding rcostheta; log1p(-rcostheta / r) would not help
+        numpy.subtract(r, rcostheta, out=r)
+        numpy.log(r, out=r)
+        r -= _LOG_AU_M
+        out -= 2.0 * numpy.einsum("b,bi->i", T_obj, r)
+        return out
 
     def solar_system_shapiro_delay(self, toas, acc_delay=None):
         """
@@ -93,23 +183,89 @@ class SolarSystemShapiro(DelayComponent):
 
         If planets are to be included, TOAs.compute_posvels() must
         have been called with the planets=True argument.
+
+        The result is cached and reused as long as the astrometry
+        parameters, PLANET_SHAPIRO and the TOA columns used are unchanged.
         """
-        # Start out with 0 delay with units of seconds
         tbl = toas.table
+        bodies = (("obs_sun_pos", self._ss_mass_sec["sun"]),)
+        if self.PLANET_SHAPIRO.value:
+            bodies += self._ss_planets
+        # The columns can be changed in place (e.g. by Table.sort or
+        # TOAs.__setitem__), so compare their contents, not the column objects
+        column_hashes = tuple(
+            hash(tbl[col].tobytes())
+            for col in ("obs", "tdbld") + tuple(c for c, _ in bodies)
+        )
+        astrometry_values = tuple(
+            (p, getattr(cp, p).value)
+            for cp in self._parent.get_components_by_category().get("astrometry", [])
+            for p in cp.params
+        )
+        param_values = (self.PLANET_SHAPIRO.value,) + astrometry_values
+        if self.shapiro_cache is not None:
+            cached_hashes, cached_values, cached_delay = self.shapiro_cache
+            if cached_hashes == column_hashes and cached_values == param_values:
+                return cached_delay * u.second
+        delay = self._compute_shapiro_delay(
+            tbl, bodies, column_hashes[:2], astrometry_values
+        )
+        self.shapiro_cache = (column_hashes, param_values, delay)
+        return delay * u.second
+
+    def _compute_shapiro_delay(self, tbl, bodies, toa_hashes, astrometry_values):
+        """Shapiro delay in seconds of the (column, mass) bodies for the TOA table.
+
+        ``toa_hashes`` are the hashes of the contents of the obs and tdbld columns.
+        """
+        # Start out with 0 delay
         delay = numpy.zeros(len(tbl))
-        for key, grp in toas.get_obs_groups():
-            if key.lower() == "barycenter":
-                log.debug("Skipping Shapiro delay for Barycentric TOAs")
-                continue
-            psr_dir = self._parent.ssb_to_psb_xyz_ICRS(
-                epoch=tbl[grp]["tdbld"].astype(numpy.float64)
+        # Barycentric TOAs have no observatory, so no Shapiro delay
+        not_bary = (
+            numpy.char.lower(numpy.asarray(tbl["obs"], dtype=str)) != "barycenter"
+        )
+        n_not_bary = numpy.count_nonzero(not_bary)
+        if n_not_bary == len(tbl):
+            # Nothing to mask, so use views and accumulate straight into delay
+            not_bary = slice(None)
+        else:
+            log.debug("Skipping Shapiro delay for Barycentric TOAs")
+            if n_not_bary == 0:
+                return delay
+        # The pulsar direction is kept separately from the delay, so it is only
+        # recomputed when the astrometry or the TOA observatories or times change
+        cache = self.psr_dir_cache
+        if (
+            cache is not None
+            and cache[0] == toa_hashes
+            and cache[1] == astrometry_values
+            and cache[2].shape[0] == n_not_bary
+        ):
+            psr_dir = cache[2]
+        else:
+            log.debug("Computing pulsar direction for Shapiro delay")
+            # A single call covering every non-barycentric TOA
+            epoch = tbl["tdbld"][not_bary].astype(numpy.float64)
+            # Without proper motion this is a single vector, so give it one row per TOA
+            psr_dir = numpy.ascontiguousarray(
+                numpy.broadcast_to(
+                    self._parent.ssb_to_psb_xyz_ICRS(epoch=epoch).value,
+                    (len(epoch), 3),
+                )
             )
-            delay[grp] += self.ss_obj_shapiro_delay(
-                tbl[grp]["obs_sun_pos"], psr_dir, self._ss_mass_sec["sun"]
+            self.psr_dir_cache = (toa_hashes, astrometry_values, psr_dir)
+        psr_dir = psr_dir.astype(_SHAPIRO_DTYPE, copy=False)
+        if len(bodies) == 1:
+            # Sun only (no PLANET_SHAPIRO): use the column as is, without stacking
+            obj_pos = tbl[bodies[0][0]].quantity.to_value(u.m)[not_bary]
+        else:
+            obj_pos = numpy.stack(
+                [tbl[col].quantity.to_value(u.m)[not_bary] for col, _ in bodies]
             )
-            if self.PLANET_SHAPIRO.value:
-                for pl in ("jupiter", "saturn", "venus", "uranus", "neptune"):
-                    delay[grp] += self.ss_obj_shapiro_delay(
-                        tbl[grp]["obs_" + pl + "_pos"], psr_dir, self._ss_mass_sec[pl]
-                    )
-        return delay * u.second
+        obj_pos = obj_pos.astype(_SHAPIRO_DTYPE, copy=False)
+        T_obj = [T for _, T in bodies]
+        if isinstance(not_bary, slice):
+            self.ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj, out=delay)
+        else:
+            delay[not_bary] = self.ss_obj_shapiro_delay(obj_pos, psr_dir, T_obj)
+        return delay
@@ -14,14 +14,11 @@ import matplotlib as mpl
 import pint.logging
 from loguru import logger as log
 
-pint.logging.setup(level=pint.logging.script_level)
-
 import pint
-from pint.pintk.paredit import ParWidget
-from pint.pintk.plk import PlkWidget, helpstring
-from pint.pintk.pulsar import Pulsar
-from pint.pintk.timedit import TimWidget
 
+# The pint.pintk widgets pull in the fitters, models and matplotlib GUI
+# backends, so they are imported where first needed rather than here, to keep
+# `pintk --help` and `pintk --version` fast.
 
 __all__ = ["main"]
 
@@ -59,6 +56,8 @@ class PINTk:
         self.updateLayout()
 
     def initUI(self):
+        from pint.pintk.plk import helpstring
+
         # Create top level menus
         top = self.mainFrame.winfo_toplevel()
         self.menuBar = tk.Menu(top)
@@ -130,6 +129,10 @@ class PINTk:
         top.bind("<Control-o>", lambda e: self.openParTim())
 
     def createWidgets(self):
+        from pint.pintk.paredit import ParWidget
+        from pint.pintk.plk import PlkWidget
+        from pint.pintk.timedit import TimWidget
+
         self.widgets = {
             "plk": PlkWidget(master=self.mainFrame, loglevel=self.loglevel),
             "par": ParWidget(master=self.mainFrame),
@@ -153,6 +156,8 @@ class PINTk:
                 visible += 1
 
     def openPulsar(self, parfile, timfile, fitter="auto", ephem=None):
+        from pint.pintk.pulsar import Pulsar
+
         self.psr = Pulsar(parfile, timfile, ephem, fitter=fitter)
         self.widgets["plk"].setPulsar(
             self.psr,
@@ -249,14 +254,13 @@ def main(argv=None):
         "--log-level",
         type=str,
         choices=("TRACE", "DEBUG", "INFO", "WARNING", "ERROR"),
-        default="WARNING",
+        default=pint.logging.script_level,
         help="Logging level",
         dest="loglevel",
     )
     args = parser.parse_args(argv)
 
-    if args.loglevel != "WARNING":
-        pint.logging.setup(level=args.loglevel)
+    pint.logging.setup(level=args.loglevel)
 
     root = tk.Tk()
     root.minsize(1000, 800)
@@ -0,0 +1,248 @@
+import copy
+import pickle
+from io import StringIO
+from types import SimpleNamespace
+
+import astropy.constants as const
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.table import Table
+from numpy.testing import assert_allclose
+
+from pint import Tsun
+import pint.models.solar_system_shapiro
+from pint.models import get_model
+from pint.models.solar_system_shapiro import SolarSystemShapiro
+from pint.toa import TOA, TOAs
+
+par = """
+PSR J1234+5678
+ELAT 0
+ELONG 0
+PMELAT 10
+PMELONG -5
+POSEPOCH 55000
+F0 100
+PEPOCH 55000
+"""
+
+
+def fake_toas(n=50):
+    # Just the table columns the Shapiro delay needs, so no ephemeris is required
+    rng = np.random.default_rng(2)
+    table = Table()
+    table["obs"] = ["gbt"] * (n - 5) + ["barycenter"] * 5
+    table["tdbld"] = np.linspace(54000, 56000, n).astype(np.longdouble)
+    table["obs_sun_pos"] = rng.normal(size=(n, 3)) * const.au
+    table["obs_sun_pos"][-5:] = 0
+    return SimpleNamespace(table=table)
+
+
+@pytest.fixture(params=["numba", "numpy"])
+def shapiro_kernel(request, monkeypatch):
+    if request.param == "numba":
+        if pint.models.solar_system_shapiro._shapiro_kernel is None:
+            pytest.skip("numba not available")
+    else:
+        monkeypatch.setattr(pint.models.solar_system_shapiro, "_shapiro_kernel", None)
+    return request.param
+
+
+def test_ss_obj_shapiro_delay_geometry(shapiro_kernel):
+    au = const.au.to_value(u.m)
+    psr_dir = np.array([[1.0, 0.0, 0.0]] * 3)
+    # Object perpendicular to, behind, and partly in front of the line of sight
+    obj_pos = np.array([[0.0, au, 0.0], [-2 * au, 0.0, 0.0], [0.5 * au, 0.5 * au, 0.0]])
+    r = np.sqrt(0.5) * au
+    expected = -2.0 * Tsun.value * np.log(np.array([1.0, 4.0, (r - 0.5 * au) / au]))
+    delay = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, Tsun.value)
+    assert isinstance(delay, np.ndarray)
+    assert_allclose(delay, expected, rtol=1e-12, atol=1e-15)
+
+
+def test_ss_obj_shapiro_delay_units(shapiro_kernel):
+    rng = np.random.default_rng(4)
+    obj_pos = rng.normal(size=(10, 3)) * const.au.to_value(u.m)
+    psr_dir = rng.normal(size=(10, 3))
+    psr_dir /= np.linalg.norm(psr_dir, axis=1)[:, None]
+    expected = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, Tsun.value)
+    for pos in [
+        (obj_pos * u.m).to(u.km),
+        Table({"pos": (obj_pos * u.m).to(u.km)})["pos"],
+    ]:
+        delay = SolarSystemShapiro.ss_obj_shapiro_delay(
+            pos, psr_dir * u.dimensionless_unscaled, Tsun.value
+        )
+        assert_allclose(delay, expected, rtol=1e-12)
+
+
+def test_ss_obj_shapiro_delay_stacked(shapiro_kernel):
+    rng = np.random.default_rng(0)
+    n = 100
+    psr_dir = rng.normal(size=(n, 3))
+    psr_dir /= np.linalg.norm(psr_dir, axis=1)[:, None]
+    obj_pos = rng.normal(size=(3, n, 3)) * const.au.to_value(u.m)
+    T = [Tsun.value, 1e-9, 1e-10]
+    total = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, T)
+    individual = sum(
+        SolarSystemShapiro.ss_obj_shapiro_delay(p, psr_dir, t)
+        for p, t in zip(obj_pos, T)
+    )
+    assert total.shape == (n,)
+    assert_allclose(total, individual, rtol=1e-12, atol=1e-15)
+
+
+def test_ss_obj_shapiro_delay_out(shapiro_kernel):
+    au = const.au.to_value(u.m)
+    psr_dir = np.array([[0.0, 0.0, 1.0]] * 2)
+    obj_pos = np.array([[0.0, 2 * au, 0.0], [3 * au, 0.0, 0.0]])
+    out = np.ones(2)
+    delay = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, 1.0, out=out)
+    assert delay is out
+    assert_allclose(out, 1.0 - 2.0 * np.log([2.0, 3.0]), rtol=1e-12)
+
+
+def test_ss_obj_shapiro_delay_float32(shapiro_kernel):
+    rng = np.random.default_rng(1)
+    n = 1000
+    psr_dir = rng.normal(size=(n, 3))
+    psr_dir /= np.linalg.norm(psr_dir, axis=1)[:, None]
+    obj_pos = rng.normal(size=(n, 3))
+    obj_pos /= np.linalg.norm(obj_pos, axis=1)[:, None]
+    # Keep clear of lines of sight close to the object, where float32 is not enough
+    far = np.einsum("ij,ij->i", obj_pos, psr_dir) < np.cos(np.radians(10))
+    obj_pos = obj_pos[far] * const.au.to_value(u.m)
+    psr_dir = psr_dir[far]
+    delay64 = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, Tsun.value)
+    delay32 = SolarSystemShapiro.ss_obj_shapiro_delay(
+        obj_pos.astype(np.float32), psr_dir.astype(np.float32), Tsun.value
+    )
+    assert np.max(np.abs(delay32 - delay64)) < 1e-9
+
+
+def test_ss_obj_shapiro_delay_single_direction(shapiro_kernel):
+    rng = np.random.default_rng(3)
+    obj_pos = rng.normal(size=(2, 10, 3)) * const.au.to_value(u.m)
+    psr_dir = np.array([0.6, 0.0, 0.8])
+    delay = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, [1.0, 2.0])
+    expected = SolarSystemShapiro.ss_obj_shapiro_delay(
+        obj_pos, np.tile(psr_dir, (10, 1)), [1.0, 2.0]
+    )
+    assert_allclose(delay, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("planets", [False, True])
+def test_solar_system_shapiro_delay_no_proper_motion(shapiro_kernel, planets):
+    # Without proper motion the pulsar direction does not depend on the epoch
+    m = get_model(
+        StringIO(
+            "PSR J1234+5678\nRAJ 12:34:00\nDECJ 10:00:00\nF0 100\nPEPOCH 55000\n"
+            + ("PLANET_SHAPIRO Y\n" if planets else "")
+        )
+    )
+    toas = fake_toas()
+    for pl in ("jupiter", "saturn", "venus", "uranus", "neptune"):
+        toas.table["obs_" + pl + "_pos"] = toas.table["obs_sun_pos"] * 5
+    delay = m.components["SolarSystemShapiro"].solar_system_shapiro_delay(toas)
+    assert np.all(delay[-5:] == 0)
+    assert np.all(np.isfinite(delay))
+    assert np.all(delay[:-5] != 0)
+
+
+def test_solar_system_shapiro_delay_cache():
+    m = get_model(StringIO(par))
+    ss = m.components["SolarSystemShapiro"]
+    toas = fake_toas()
+    delay = ss.solar_system_shapiro_delay(toas)
+    assert np.all(delay[-5:] == 0)
+    assert ss.shapiro_cache is not None
+    assert copy.deepcopy(m).components["SolarSystemShapiro"].shapiro_cache is None
+
+    # Reused while nothing changes
+    ss.shapiro_cache[2][:] = 1
+    assert np.all(ss.solar_system_shapiro_delay(toas) == 1 * u.s)
+
+    # Recomputed when the astrometry changes
+    m.ELONG.value = 1
+    moved = ss.solar_system_shapiro_delay(toas)
+    assert np.all(moved != 1 * u.s)
+    m.ELONG.value = 0
+    assert_allclose(ss.solar_system_shapiro_delay(toas), delay)
+
+    # Recomputed when the TOA columns are modified in place
+    toas.table["obs_sun_pos"][0] *= 2
+    modified = ss.solar_system_shapiro_delay(toas)
+    assert modified[0] != delay[0]
+    assert_allclose(modified[1:], delay[1:])
+    toas.table.sort("tdbld", reverse=True)
+    assert_allclose(ss.solar_system_shapiro_delay(toas), modified[::-1])
+
+    # Recomputed when the TOA columns are replaced
+    toas.table["obs_sun_pos"] = toas.table["obs_sun_pos"] * 2
+    assert np.all(ss.solar_system_shapiro_delay(toas)[5:] != modified[::-1][5:])
+
+
+def test_psr_dir_cache():
+    m = get_model(StringIO(par))
+    ss = m.components["SolarSystemShapiro"]
+    toas = fake_toas()
+    delay = ss.solar_system_shapiro_delay(toas)
+    psr_dir = ss.psr_dir_cache[2]
+    assert psr_dir.shape == (45, 3)
+    assert copy.deepcopy(m).components["SolarSystemShapiro"].psr_dir_cache is None
+
+    # Reused when only the object positions change
+    toas.table["obs_sun_pos"][0] *= 2
+    assert ss.solar_system_shapiro_delay(toas)[0] != delay[0]
+    assert ss.psr_dir_cache[2] is psr_dir
+
+    # Not when the position does
+    m.ELAT.value = 30
+    ss.solar_system_shapiro_delay(toas)
+    assert ss.psr_dir_cache[2] is not psr_dir
+
+
+def test_psr_dir_cache_in_place_changes():
+    m = get_model(StringIO(par))
+    ss = m.components["SolarSystemShapiro"]
+    toas = fake_toas()
+    ss.solar_system_shapiro_delay(toas)
+
+    # Sorting the table in place reorders the TOAs
+    toas.table.sort("tdbld", reverse=True)
+    delay = ss.solar_system_shapiro_delay(toas)
+    ss.setup()
+    assert_allclose(ss.solar_system_shapiro_delay(toas), delay)
+
+    # Changing an observatory in place changes which TOAs get a delay
+    toas.table["obs"][-1] = "barycenter"
+    delay = ss.solar_system_shapiro_delay(toas)
+    assert delay[-1] == 0
+    assert ss.psr_dir_cache[2].shape == (44, 3)
+
+
+def test_solar_system_shapiro_delay_leaves_toas_alone():
+    # Nothing is stored on the TOAs, so they still compare, copy and pickle
+    m = get_model(StringIO(par))
+    toas = TOAs(toalist=[TOA(55000 + i, obs="gbt", freq=1400) for i in range(10)])
+    toas.table["tdbld"] = toas.table["mjd_float"].astype(np.longdouble)
+    toas.table["obs_sun_pos"] = np.random.default_rng(5).normal(size=(10, 3)) * const.au
+    other = copy.deepcopy(toas)
+    m.components["SolarSystemShapiro"].solar_system_shapiro_delay(toas)
+    assert toas == other
+    assert copy.deepcopy(toas) == toas
+    assert pickle.loads(pickle.dumps(toas)) == toas
+    m.components["SolarSystemShapiro"].solar_system_shapiro_delay(other)
+    assert toas == other
+
+
+def test_ss_obj_shapiro_delay_near_alignment(shapiro_kernel):
+    # Line of sight passing close to the object, where r - r cos(theta) is small
+    au = const.au.to_value(u.m)
+    theta = np.array([1e-2, 1e-3, 1e-4])
+    obj_pos = au * np.array([np.cos(theta), np.sin(theta), np.zeros_like(theta)]).T
+    psr_dir = np.array([[1.0, 0.0, 0.0]] * len(theta))
+    expected = -2.0 * Tsun.value * np.log(2 * np.sin(theta / 2) ** 2)
+    delay = SolarSystemShapiro.ss_obj_shapiro_delay(obj_pos, psr_dir, Tsun.value)
+    assert_allclose(delay, expected, rtol=0, atol=1e-12)